@@ -9,16 +9,262 @@ Can be tested locally or deployed to Azure AI Foundry as an agent.
 
 import os
 import json
-import requests
+import time
+import asyncio
+import threading
+import hashlib
+import functools
+import itertools
+from collections import OrderedDict, namedtuple
 from typing import Optional
+import diskcache
+import httpx
+import numpy as np
+import orjson
+import tiktoken
 from dotenv import load_dotenv
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 
 # Load environment variables
 load_dotenv()
 
 
+# Reply used when retrieval finds nothing relevant enough to send to the model
+NO_CONTEXT_RESPONSE = "I don't have information on that in the indexed content."
+
+# Framing of the retrieved-context message sent to the chat model
+_CONTEXT_PREFIX = "Retrieved context:\n\n"
+_PASSAGE_SEPARATOR = "\n\n---\n\n"
+
+# Smallest amount of chunk content worth sending when a passage has to be cut
+_MIN_PASSAGE_TOKENS = 32
+
+# Compact JSON serializer for streamed events
+_DUMP = functools.partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+
+
+class _CharEstimateEncoding:
+    """
+    Stand-in for a tiktoken encoding that treats every 4 characters as a token.
+
+    Used when the real encoding cannot be loaded (tiktoken downloads it on
+    first use, which fails offline or behind restricted egress).
+    """
+
+    chars_per_token = 4
+
+    def encode(self, text: str) -> list:
+        size = self.chars_per_token
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """
+    Return the tokenizer for a chat model, defaulting to o200k_base for unknown
+    deployment names and to a character estimate if tiktoken cannot load it.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"⚠️ Could not load tokenizer for {model} ({e}); estimating tokens from characters")
+        return _CharEstimateEncoding()
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+# Disk cache statistics; sizes are in bytes rather than entries
+DiskCacheInfo = namedtuple("DiskCacheInfo", ["hits", "misses", "size_limit", "volume"])
+
+
+class LRUCache:
+    """
+    Small least-recently-used cache with functools.lru_cache-style statistics.
+
+    Used instead of functools.lru_cache because the embedding calls it fronts
+    are coroutines, whose results cannot be memoized by the decorator.
+    """
+
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, is_valid=None):
+        """
+        Return the cached value for key, or None on a miss.
+
+        If is_valid is given and returns False for the cached value, the entry
+        is evicted and the lookup counts as a miss.
+        """
+        if key in self._data:
+            value = self._data[key]
+            if is_valid is None or is_valid(value):
+                self._data.move_to_end(key)
+                self._hits += 1
+                return value
+            del self._data[key]
+        self._misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entry if full."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses, self.maxsize, len(self._data))
+
+
+def _to_unit_f32(values) -> np.ndarray:
+    """
+    Convert an embedding to a read-only, L2-normalized float32 array.
+
+    With unit-length vectors, cosine similarity is a plain dot product.
+    """
+    vector = np.array(values, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    vector.setflags(write=False)
+    return vector
+
+
+# Query embeddings (unit float32 arrays) keyed by (model, normalized text),
+# shared by all agents in the process. The model is part of the key so switching EMBEDDING_MODEL_NAME
+# never returns a vector produced by a different model.
+_embedding_cache = LRUCache(maxsize=2048)
+
+
+class EmbeddingCache:
+    """
+    Disk-backed embedding store that survives process restarts.
+
+    Entries are keyed by sha256(model + "\0" + normalized text) and stored as
+    packed float32 bytes.
+    """
+
+    def __init__(self, directory: str, size_limit: int = 1 << 30, ttl_seconds: Optional[float] = None):
+        self._cache = diskcache.Cache(directory, size_limit=size_limit)
+        self.size_limit = size_limit
+        self.ttl_seconds = ttl_seconds
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the stored vector for key as a read-only float32 array, or None on a miss."""
+        data = self._cache.get(key)
+        if data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return np.frombuffer(data, dtype=np.float32)
+
+    def put(self, key: str, vector: np.ndarray):
+        """Store vector under key."""
+        self._cache.set(key, np.asarray(vector, dtype=np.float32).tobytes(), expire=self.ttl_seconds)
+
+    def get_many(self, keys: list) -> dict:
+        """Return {key: vector} for the keys found in the cache."""
+        found = {key: self.get(key) for key in keys}
+        return {key: vector for key, vector in found.items() if vector is not None}
+
+    def put_many(self, items: dict):
+        """Store every {key: vector} pair in items."""
+        for key, vector in items.items():
+            self.put(key, vector)
+
+    def cache_info(self) -> DiskCacheInfo:
+        return DiskCacheInfo(self._hits, self._misses, self.size_limit, self._cache.volume())
+
+
+def _relevance(chunk: dict) -> tuple:
+    """Sort key for retrieved chunks: semantic reranker score when present, then search score."""
+    return (chunk.get("reranker_score", 0), chunk["score"])
+
+
+def _max_embedding_batch(model: str) -> int:
+    """Maximum number of inputs accepted by a single embeddings request."""
+    return 16 if "ada-002" in model else 2048
+
+
+def _batched(iterable, size: int):
+    """Yield successive lists of at most size items from iterable."""
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class SemanticCache:
+    """
+    In-memory cache of chat responses looked up by query embedding similarity.
+
+    Query embeddings must be unit-length float32 vectors. They are quantized to
+    int8 with a per-row scale and kept in a preallocated ring buffer of
+    ``capacity`` rows, so cosine similarity against every cached query is a
+    single matrix-vector product over a quarter of the float32 memory; once
+    the buffer is full the oldest entry is overwritten. Each entry also carries a hash of the
+    prompt configuration it was generated with; a similar query only hits if
+    that hash matches too.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 3600, capacity: int = 1000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.capacity = capacity
+        self._matrix = None  # int8 rows, allocated on first add once the dimension is known
+        self._scales = np.zeros(capacity, dtype=np.float32)
+        self._expires_at = np.zeros(capacity)
+        self._entries = [None] * capacity  # (prompt_hash, payload) per matrix row
+        self._size = 0
+        self._next = 0
+
+    def lookup(self, query_embedding: np.ndarray, prompt_hash: str) -> Optional[dict]:
+        """Return the cached payload for a sufficiently similar query, if any."""
+        if not self._size:
+            return None
+
+        scores = (self._matrix[:self._size].astype(np.float32) @ query_embedding) * self._scales[:self._size]
+        scores[self._expires_at[:self._size] <= time.time()] = -np.inf
+        other_config = np.fromiter(
+            (entry_hash != prompt_hash for entry_hash, _ in self._entries[:self._size]),
+            dtype=bool, count=self._size
+        )
+        scores[other_config] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        return self._entries[best][1]
+
+    def add(self, query_embedding: np.ndarray, prompt_hash: str, payload: dict):
+        """Store a response payload under the given query embedding."""
+        if self._matrix is None:
+            self._matrix = np.empty((self.capacity, query_embedding.shape[0]), dtype=np.int8)
+
+        row = self._next
+        scale = float(np.max(np.abs(query_embedding))) / 127 or 1.0
+        self._matrix[row] = np.round(query_embedding / scale).astype(np.int8)
+        self._scales[row] = scale
+        self._expires_at[row] = time.time() + self.ttl_seconds
+        self._entries[row] = (prompt_hash, payload)
+        self._next = (row + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+
 class MultiModalRAGAgent:
     """
     A RAG agent that can answer questions based on multi-modal content
@@ -31,15 +277,73 @@ class MultiModalRAGAgent:
         self.azure_ai_endpoint = os.getenv("AZURE_AI_ENDPOINT")
         self.embedding_model = os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-3-large")
         self.chat_model = os.getenv("CHAT_MODEL_NAME", "gpt-4o")
+        self.embedding_batch_size = min(
+            int(os.getenv("EMBEDDING_BATCH_SIZE", "2048")),
+            _max_embedding_batch(self.embedding_model)
+        )
+
+        # Batch chat limits: messages accepted per batch, and queries of one batch
+        # that may be searching/generating at the same time
+        self.max_batch_messages = int(os.getenv("CHAT_BATCH_MAX_MESSAGES", "64"))
+        self.batch_concurrency = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
 
         # Azure Search configuration
         self.search_endpoint = os.getenv("SEARCH_SERVICE_ENDPOINT", "").strip().rstrip('/')
         self.search_index = os.getenv("SEARCH_SERVICE_INDEX_NAME", "multi-modal-rag-index")
+        # Further indexes with the same schema (e.g. image descriptions), queried alongside
+        self.extra_search_indexes = [
+            name.strip()
+            for name in os.getenv("SEARCH_SERVICE_EXTRA_INDEX_NAMES", "").split(",")
+            if name.strip()
+        ]
+
+        # Optional hybrid (keyword + vector) retrieval and semantic ranking
+        self.hybrid_search = os.getenv("SEARCH_HYBRID", "false").lower() == "true"
+        self.semantic_config = os.getenv("SEARCH_SEMANTIC_CONFIG", "")
+
+        # Prompt token budget shared by the system prompt, query and retrieved context
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
 
         # Authentication
         self.auth_mode = os.getenv("AUTH_MODE", "entra").lower()
-        self.credential = None
         self.openai_client = None
+        self._http = None
+        self._loop = None
+        self._inflight = {}
+        self._credential = None
+        self._openai_token_provider = None
+        self._credential_lock = threading.Lock()
+        self._search_headers = None
+        self._search_token_expires_on = 0
+
+        # Persistent embedding cache (disabled when EMBEDDING_CACHE_DIR is empty)
+        cache_dir = os.getenv("EMBEDDING_CACHE_DIR", ".cache/embeddings")
+        cache_ttl = os.getenv("EMBEDDING_CACHE_TTL_SECONDS")
+        self.embedding_cache = EmbeddingCache(
+            cache_dir,
+            size_limit=int(os.getenv("EMBEDDING_CACHE_SIZE_LIMIT", str(1 << 30))),
+            ttl_seconds=float(cache_ttl) if cache_ttl else None
+        ) if cache_dir else None
+
+        # Recent search results, reused for repeat queries with the same or smaller top_k
+        self.search_cache = LRUCache(maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "512")))
+        self.search_cache_ttl = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+
+        # Queries whose best search score is below this floor skip the chat model.
+        # Hybrid queries are scored by reciprocal rank fusion (at most ~0.033), so
+        # they get their own floor, disabled by default.
+        if self.hybrid_search:
+            self.min_context_score = float(os.getenv("MIN_HYBRID_CONTEXT_SCORE", "0"))
+        else:
+            self.min_context_score = float(os.getenv("MIN_CONTEXT_SCORE", "0.02"))
+        self.low_score_skips = 0
+
+        # Semantic response cache
+        self.semantic_cache = SemanticCache(
+            threshold=float(os.getenv("CACHE_SIMILARITY_THRESHOLD", "0.95")),
+            ttl_seconds=float(os.getenv("CACHE_TTL_SECONDS", "3600")),
+            capacity=int(os.getenv("SEMANTIC_CACHE_CAPACITY", "1000"))
+        )
 
         # System prompt for the agent
         self.system_prompt = """
@@ -50,12 +354,8 @@ Always follow these rules:
 1. Answer strictly from the context provided. Do not invent, assume, or add details outside the given context.
 2. If no relevant information is available in the context, politely say so.
 3. Do not include any external links, citations, or references unless they are explicitly present in the context object.
-4. Context format: The system will pass a Python list of objects, each containing:
-   {
-     "chunk": "the content (text, JSON, transcript, or description)",
-     "title": "the document title",
-     "score": "the relevancy score"
-   }
+4. Context format: The context is passed as a message starting with "Retrieved context:", followed by passages separated by "---".
+   Each passage starts with the document title in square brackets, followed by the content (text, JSON, transcript, or description).
    These are the top matches based on cosine similarity with the user query.
 5. Style & tone:
    - Respond in a professional, natural way, as if conversing with a human.
@@ -66,17 +366,64 @@ Always follow these rules:
 Your role is to act like a knowledgeable human assistant who can reference the provided information smoothly and contextually, across any modality (text, image, video, or audio).
 """
 
+        # Static prompt pieces, built once instead of on every request
+        self._sys_msg = {"role": "system", "content": self.system_prompt}
+        self._prompt_hash_base = hashlib.sha256(
+            f"{self.chat_model}\0{self.system_prompt}\0".encode("utf-8")
+        )
+
         self._initialize_clients()
 
+    @property
+    def credential(self) -> DefaultAzureCredential:
+        """
+        Entra ID credential, built on first use since construction scans the
+        environment. Access it from a worker thread, not the event loop.
+        """
+        with self._credential_lock:
+            if self._credential is None:
+                self._credential = DefaultAzureCredential()
+            return self._credential
+
+    def _get_openai_token(self) -> str:
+        """Return an Azure OpenAI bearer token; blocking, so call it from a worker thread."""
+        if self._openai_token_provider is None:
+            credential = self.credential
+            with self._credential_lock:
+                if self._openai_token_provider is None:
+                    self._openai_token_provider = get_bearer_token_provider(
+                        credential,
+                        "https://cognitiveservices.azure.com/.default"
+                    )
+        return self._openai_token_provider()
+
+    # Token counting is resolved on first use: loading a tiktoken encoding may
+    # download it, which should not happen (or fail) while constructing the agent
+
+    @functools.cached_property
+    def _encoding(self):
+        return _get_encoding(self.chat_model)
+
+    @functools.cached_property
+    def _sys_token_count(self) -> int:
+        return len(self._encoding.encode(self.system_prompt))
+
+    @functools.cached_property
+    def _context_overhead_tokens(self) -> int:
+        return len(self._encoding.encode(_CONTEXT_PREFIX))
+
+    @functools.cached_property
+    def _separator_token_count(self) -> int:
+        return len(self._encoding.encode(_PASSAGE_SEPARATOR))
+
     def _initialize_clients(self):
         """Initialize Azure OpenAI and authentication clients."""
         if self.auth_mode == "entra":
-            self.credential = DefaultAzureCredential()
-            token_provider = get_bearer_token_provider(
-                self.credential,
-                "https://cognitiveservices.azure.com/.default"
-            )
-            self.openai_client = AzureOpenAI(
+            # Token refreshes block on the credential chain; keep them off the event loop
+            async def token_provider():
+                return await asyncio.to_thread(self._get_openai_token)
+
+            self.openai_client = AsyncAzureOpenAI(
                 azure_ad_token_provider=token_provider,
                 api_version="2024-02-15-preview",
                 azure_endpoint=self.azure_ai_endpoint
@@ -84,41 +431,180 @@ Your role is to act like a knowledgeable human assistant who can reference the p
             print("✅ Agent initialized with Entra ID authentication")
         else:
             api_key = os.getenv("AZURE_AI_API_KEY")
-            self.openai_client = AzureOpenAI(
+            self.openai_client = AsyncAzureOpenAI(
                 api_key=api_key,
                 api_version="2024-02-15-preview",
                 azure_endpoint=self.azure_ai_endpoint
             )
+            self._search_headers = {
+                "Content-Type": "application/json",
+                "api-key": os.getenv("SEARCH_SERVICE_API_KEY")
+            }
             print("✅ Agent initialized with API Key authentication")
 
-    def _generate_embedding(self, text: str) -> list:
-        """Generate vector embedding for the given text."""
-        response = self.openai_client.embeddings.create(
-            input=text,
-            model=self.embedding_model
+        # Shared HTTP client for Azure AI Search REST calls; keep-alive and HTTP/2
+        # let consecutive queries reuse one TLS connection instead of reconnecting
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=30.0
         )
-        return response.data[0].embedding
 
-    def _search_index(self, query_embedding: list, top_k: int = 5) -> list:
-        """Search the Azure AI Search index with vector similarity."""
-        url = f"{self.search_endpoint}/indexes/{self.search_index}/docs/search?api-version=2023-11-01"
+    async def aclose(self):
+        """Release the HTTP connections held by the agent."""
+        await self._http.aclose()
+        await self.openai_client.close()
 
-        # Set up headers based on auth mode
-        if self.auth_mode == "entra":
-            token = self.credential.get_token("https://search.azure.com/.default").token
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token}"
-            }
-        else:
-            headers = {
+    async def _generate_embeddings(self, texts: list) -> list:
+        """
+        Generate unit-length float32 embeddings for several texts.
+
+        Vectors are looked up in the in-memory LRU, then the disk cache; texts
+        missing from both are embedded in requests of up to
+        EMBEDDING_BATCH_SIZE inputs.
+        """
+        # The normalized text is only the cache key; the API gets the original text
+        keys = [(self.embedding_model, text.strip().lower()) for text in texts]
+        originals = {}
+        for key, text in zip(keys, texts):
+            originals.setdefault(key, text)
+        vectors = {key: _embedding_cache.get(key) for key in keys}
+
+        # Disk cache I/O runs in a worker thread so it never blocks the event loop
+        uncached = self._find_uncached(vectors)
+        if self.embedding_cache is not None and uncached:
+            disk_keys = {EmbeddingCache.key(*key): key for key in uncached}
+            found = await asyncio.to_thread(self.embedding_cache.get_many, list(disk_keys))
+            for disk_key, vector in found.items():
+                vectors[disk_keys[disk_key]] = vector
+                _embedding_cache.put(disk_keys[disk_key], vector)
+
+        embedded = {}
+        for batch in _batched(self._find_uncached(vectors), self.embedding_batch_size):
+            response = await self.openai_client.embeddings.create(
+                input=[originals[key] for key in batch],
+                model=self.embedding_model
+            )
+            for key, item in zip(batch, sorted(response.data, key=lambda d: d.index)):
+                vectors[key] = _to_unit_f32(item.embedding)
+                _embedding_cache.put(key, vectors[key])
+                embedded[EmbeddingCache.key(*key)] = vectors[key]
+
+        if self.embedding_cache is not None and embedded:
+            await asyncio.to_thread(self.embedding_cache.put_many, embedded)
+
+        return [vectors[key] for key in keys]
+
+    def _find_uncached(self, vectors: dict) -> list:
+        """Return the keys of vectors that have not been resolved yet."""
+        return [key for key, vector in vectors.items() if vector is None]
+
+    async def _embed_f32(self, text: str) -> np.ndarray:
+        """Generate a unit-length float32 embedding for the given text (cached per model)."""
+        key = f"embed\0{self.embedding_model}\0{text.strip().lower()}"
+        embeddings = await self._coalesce(key, lambda: self._generate_embeddings([text]))
+        return embeddings[0]
+
+    async def _coalesce(self, key: str, factory):
+        """
+        Run factory() at most once at a time per key.
+
+        Concurrent callers with the same key await the in-flight call's result
+        instead of repeating the work. The work runs as its own task, so a
+        cancelled caller (e.g. a disconnected client) stops waiting without
+        cancelling it for the others. No lock is needed: nothing awaits
+        between the lookup and the registration of the task.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._finish_inflight, key))
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved in case every caller went away
+
+    @staticmethod
+    def cache_info() -> CacheInfo:
+        """Return hit/miss statistics of the in-memory embedding cache."""
+        return _embedding_cache.cache_info()
+
+    def stats(self) -> dict:
+        """Operational counters of this agent (one per worker process)."""
+        return {
+            "pid": os.getpid(),
+            "embedding_cache": self.cache_info()._asdict(),
+            "disk_embedding_cache": (
+                self.embedding_cache.cache_info()._asdict() if self.embedding_cache is not None else None
+            ),
+            "min_context_score": self.min_context_score,
+            "low_score_skips": self.low_score_skips
+        }
+
+    async def _get_search_headers(self) -> dict:
+        """
+        Return request headers for Azure AI Search.
+
+        In Entra mode the bearer token is cached and only refreshed once it is
+        within five minutes of expiring. The refresh, including building the
+        credential on first use, runs in a worker thread because it is blocking.
+        """
+        if self.auth_mode == "entra" and time.time() > self._search_token_expires_on - 300:
+            access_token = await asyncio.to_thread(
+                lambda: self.credential.get_token("https://search.azure.com/.default")
+            )
+            self._search_headers = {
                 "Content-Type": "application/json",
-                "api-key": os.getenv("SEARCH_SERVICE_API_KEY")
+                "Authorization": f"Bearer {access_token.token}"
             }
+            self._search_token_expires_on = access_token.expires_on
+        return self._search_headers
+
+    async def _search_index(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int = 5,
+        query_text: Optional[str] = None,
+        index: Optional[str] = None
+    ) -> list:
+        """
+        Search the Azure AI Search index with vector similarity.
+
+        When SEARCH_HYBRID is enabled and query_text is given, the query text
+        is also matched by keyword, and SEARCH_SEMANTIC_CONFIG (if set) turns
+        on semantic ranking; the reranker score is then kept as
+        'reranker_score'. index defaults to SEARCH_SERVICE_INDEX_NAME.
+
+        Results are cached per query for SEARCH_CACHE_TTL_SECONDS; a later
+        identical request with top_k no larger than the cached one is answered
+        by slicing the cached results.
+        """
+        index = index or self.search_index
+        search_text = query_text if self.hybrid_search else None
+
+        cache_key = hashlib.sha256(query_embedding.tobytes())
+        cache_key.update(f"\0{index}\0{search_text or ''}".encode("utf-8"))
+        cache_key = cache_key.hexdigest()
+        # Expired entries, or ones fetched with a smaller top_k, are misses; the
+        # fresh results below replace them
+        cached = self.search_cache.get(
+            cache_key,
+            is_valid=lambda entry: top_k <= entry[0] and time.time() < entry[1]
+        )
+        if cached is not None:
+            return cached[2][:top_k]
+
+        url = f"{self.search_endpoint}/indexes/{index}/docs/search?api-version=2023-11-01"
+        headers = await self._get_search_headers()
 
         body = {
             "count": True,
             "select": "content_text, document_title",
+            "top": top_k,
             "vectorQueries": [{
                 "vector": query_embedding,
                 "k": top_k,
@@ -126,36 +612,133 @@ Your role is to act like a knowledgeable human assistant who can reference the p
                 "kind": "vector"
             }]
         }
+        if search_text:
+            body["search"] = search_text
+            if self.semantic_config:
+                body["queryType"] = "semantic"
+                body["semanticConfiguration"] = self.semantic_config
 
-        response = requests.post(url, headers=headers, json=body)
+        # orjson writes the float32 vector directly and parses the (potentially
+        # large) response body several times faster than the stdlib json module
+        response = await self._http.post(
+            url, headers=headers, content=orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
+        )
         response.raise_for_status()
 
-        results = response.json().get('value', [])
-        return [
-            {
+        results = []
+        for doc in orjson.loads(response.content).get('value', []):
+            result = {
                 "chunk": doc.get('content_text', ''),
                 "title": doc.get('document_title', 'Unknown'),
                 "score": doc.get('@search.score', 0)
             }
-            for doc in results
+            if doc.get('@search.rerankerScore') is not None:
+                result["reranker_score"] = doc['@search.rerankerScore']
+            results.append(result)
+
+        self.search_cache.put(cache_key, (top_k, time.time() + self.search_cache_ttl, results))
+        return results
+
+    async def _retrieve(self, query_embedding: np.ndarray, top_k: int, query_text: str) -> list:
+        """
+        Search the main index and any extra indexes concurrently.
+
+        Results are merged by relevance (see _relevance) and cut to top_k; all
+        indexes are embedded with the same model, so their scores are comparable.
+        """
+        indexes = [self.search_index, *self.extra_search_indexes]
+        if len(indexes) == 1:
+            return await self._search_index(query_embedding, top_k, query_text=query_text)
+
+        results = await asyncio.gather(*(
+            self._search_index(query_embedding, top_k, query_text=query_text, index=index)
+            for index in indexes
+        ))
+        merged = sorted(itertools.chain.from_iterable(results), key=_relevance, reverse=True)
+        return merged[:top_k]
+
+    def _prompt_hash(self, top_k: int) -> str:
+        """Hash of the settings that shape a response, used to validate cache hits."""
+        digest = self._prompt_hash_base.copy()
+        digest.update(str(top_k).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _pack_context(self, query: str, context: list) -> list:
+        """
+        Select passages for the prompt within CONTEXT_TOKEN_BUDGET.
+
+        Chunks are taken greedily by descending relevance until the tokens left
+        after the system prompt and query run out. The chunk that crosses the
+        budget is cut at a token boundary, or dropped if fewer than
+        _MIN_PASSAGE_TOKENS of its content would fit.
+        """
+        remaining = (
+            self.context_token_budget
+            - self._sys_token_count
+            - self._context_overhead_tokens
+            - len(self._encoding.encode(query))
+        )
+
+        passages = []
+        for c in sorted(context, key=_relevance, reverse=True):
+            if passages:
+                remaining -= self._separator_token_count
+            if remaining <= 0:
+                break
+
+            header = f"[{c['title']}]\n"
+            header_tokens = len(self._encoding.encode(header))
+            chunk_tokens = self._encoding.encode(c['chunk'])
+            if header_tokens + len(chunk_tokens) <= remaining:
+                passages.append(header + c['chunk'])
+                remaining -= header_tokens + len(chunk_tokens)
+                continue
+
+            room = remaining - header_tokens
+            if room >= _MIN_PASSAGE_TOKENS:
+                # A cut inside a multi-byte character decodes to U+FFFD; drop it
+                partial = self._encoding.decode(chunk_tokens[:room]).rstrip("\ufffd")
+                passages.append(header + partial)
+            break
+
+        return passages
+
+    def _build_messages(self, query: str, context: list) -> list:
+        """Build the chat completion messages for a query and its retrieved context."""
+        # Plain-text passages tokenize tighter than JSON; scores stay in the result
+        # returned to the caller since the model only needs the text
+        passages = _PASSAGE_SEPARATOR.join(self._pack_context(query, context))
+
+        return [
+            self._sys_msg,
+            {"role": "assistant", "content": f"{_CONTEXT_PREFIX}{passages}"},
+            {"role": "user", "content": query}
         ]
 
-    def _generate_response(self, query: str, context: list) -> str:
+    async def _generate_response(self, query: str, context: list) -> str:
         """Generate a response using Azure OpenAI with the retrieved context."""
-        user_message = f"The user query is: {query}\nThe context is: {json.dumps(context, indent=2)}"
-
-        response = self.openai_client.chat.completions.create(
+        response = await self.openai_client.chat.completions.create(
             model=self.chat_model,
-            messages=[
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            messages=self._build_messages(query, context),
             temperature=0.7
         )
 
         return response.choices[0].message.content
 
-    def chat(self, user_message: str, top_k: int = 5) -> dict:
+    async def _generate_response_stream(self, query: str, context: list):
+        """Generate a response like _generate_response, yielding text as it arrives."""
+        response = await self.openai_client.chat.completions.create(
+            model=self.chat_model,
+            messages=self._build_messages(query, context),
+            temperature=0.7,
+            stream=True
+        )
+
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def chat(self, user_message: str, top_k: int = 5) -> dict:
         """
         Process a user message and return a response.
 
@@ -164,31 +747,177 @@ Your role is to act like a knowledgeable human assistant who can reference the p
             top_k: Number of documents to retrieve from the index
 
         Returns:
-            dict with 'response', 'sources', and 'query'
+            dict with 'response', 'sources', 'query' and 'cache_hit'
         """
+        # Identical concurrent queries share a single embedding/search/completion run
+        result = await self._coalesce(
+            self._chat_key(user_message, top_k), lambda: self._chat(user_message, top_k)
+        )
+        return {**result, "query": user_message}
+
+    @staticmethod
+    def _chat_key(user_message: str, top_k: int) -> str:
+        """In-flight key identifying an answer to a query, shared by chat() and chat_many()."""
+        return hashlib.sha256(f"chat\0{top_k}\0{user_message.strip().lower()}".encode("utf-8")).hexdigest()
+
+    async def _chat(self, user_message: str, top_k: int) -> dict:
         try:
             # Step 1: Generate embedding for the query
-            query_embedding = self._generate_embedding(user_message)
+            query_embedding = await self._embed_f32(user_message)
+        except Exception as e:
+            return self._error_result(user_message, e)
+
+        return await self._answer(user_message, query_embedding, top_k)
+
+    async def chat_many(self, messages: list, top_k: int = 5) -> list:
+        """
+        Process several user messages concurrently.
+
+        All queries are embedded in batched embeddings requests, then each
+        query's retrieval and generation run in parallel, at most
+        CHAT_BATCH_CONCURRENCY at a time.
+
+        Returns:
+            list of result dicts in the same order as messages, as from chat()
+        """
+        if len(messages) > self.max_batch_messages:
+            raise ValueError(
+                f"Batch of {len(messages)} messages exceeds the limit of {self.max_batch_messages}"
+            )
+
+        try:
+            embeddings = await self._generate_embeddings(messages)
+        except Exception as e:
+            return [self._error_result(message, e) for message in messages]
+
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def bounded_answer(message, embedding):
+            async with semaphore:
+                return await self._answer(message, embedding, top_k)
 
-            # Step 2: Search the index
-            context = self._search_index(query_embedding, top_k)
+        async def answer(message, embedding):
+            # Shares work with duplicates in the batch and with concurrent chat() calls
+            result = await self._coalesce(
+                self._chat_key(message, top_k), lambda: bounded_answer(message, embedding)
+            )
+            return {**result, "query": message}
+
+        return await asyncio.gather(*(
+            answer(message, embedding)
+            for message, embedding in zip(messages, embeddings)
+        ))
+
+    async def chat_stream(self, user_message: str, top_k: int = 5):
+        """
+        Process a user message and stream the response as it is generated.
+
+        Yields dict events: first {'sources', 'cache_hit'}, then {'delta'} for
+        each piece of response text. If processing fails, an {'error'} event
+        is yielded and the stream ends.
+        """
+        try:
+            query_embedding = await self._embed_f32(user_message)
 
-            # Step 3: Generate response
-            response = self._generate_response(user_message, context)
+            prompt_hash = self._prompt_hash(top_k)
+            cached = self.semantic_cache.lookup(query_embedding, prompt_hash)
+            if cached is not None:
+                yield {"sources": cached["sources"], "cache_hit": True}
+                yield {"delta": cached["response"]}
+                return
+
+            context = await self._retrieve(query_embedding, top_k, user_message)
+            if not self._has_relevant_context(context):
+                yield {"sources": [], "cache_hit": False}
+                yield {"delta": NO_CONTEXT_RESPONSE}
+                return
+
+            yield {"sources": context, "cache_hit": False}
+
+            parts = []
+            async for delta in self._generate_response_stream(user_message, context):
+                parts.append(delta)
+                yield {"delta": delta}
+
+            self.semantic_cache.add(
+                query_embedding, prompt_hash, {"response": "".join(parts), "sources": context}
+            )
+
+        except Exception as e:
+            yield {"error": str(e)}
+
+    def _run(self, coro):
+        """Run a coroutine on the agent's private event loop."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    def chat_sync(self, user_message: str, top_k: int = 5) -> dict:
+        """Blocking wrapper around chat() for synchronous callers such as the CLI."""
+        return self._run(self.chat(user_message, top_k))
+
+    def chat_stream_sync(self, user_message: str, top_k: int = 5):
+        """Blocking wrapper around chat_stream() for synchronous callers such as the CLI."""
+        stream = self.chat_stream(user_message, top_k)
+        while True:
+            try:
+                yield self._run(stream.__anext__())
+            except StopAsyncIteration:
+                return
+
+    @staticmethod
+    def _error_result(user_message: str, error: Exception) -> dict:
+        return {
+            "response": f"I encountered an error while processing your request: {str(error)}",
+            "sources": [],
+            "query": user_message,
+            "error": str(error)
+        }
+
+    def _has_relevant_context(self, context: list) -> bool:
+        """Whether any chunk was retrieved and the best one clears the score floor; counts the misses."""
+        best = max((c["score"] for c in context), default=0)
+        if not context or best < self.min_context_score:
+            self.low_score_skips += 1
+            print(f"ℹ️ Skipping chat model: best score {best:.4f} below floor {self.min_context_score}")
+            return False
+        return True
+
+    async def _answer(self, user_message: str, query_embedding: np.ndarray, top_k: int) -> dict:
+        """Answer a query whose embedding is already known."""
+        try:
+            # Step 2: Reuse the answer to a semantically equivalent query
+            prompt_hash = self._prompt_hash(top_k)
+            cached = self.semantic_cache.lookup(query_embedding, prompt_hash)
+            if cached is not None:
+                return {**cached, "query": user_message, "cache_hit": True}
+
+            # Step 3: Search the index
+            context = await self._retrieve(query_embedding, top_k, user_message)
+            if not self._has_relevant_context(context):
+                return {
+                    "response": NO_CONTEXT_RESPONSE,
+                    "sources": [],
+                    "query": user_message,
+                    "cache_hit": False
+                }
+
+            # Step 4: Generate response
+            response = await self._generate_response(user_message, context)
+
+            self.semantic_cache.add(
+                query_embedding, prompt_hash, {"response": response, "sources": context}
+            )
 
             return {
                 "response": response,
                 "sources": context,
-                "query": user_message
+                "query": user_message,
+                "cache_hit": False
             }
 
         except Exception as e:
-            return {
-                "response": f"I encountered an error while processing your request: {str(e)}",
-                "sources": [],
-                "query": user_message,
-                "error": str(e)
-            }
+            return self._error_result(user_message, e)
 
 
 def create_agent() -> MultiModalRAGAgent:
@@ -239,15 +968,21 @@ def run_interactive_cli():
 
             # Process the query
             print("\n🔍 Searching knowledge base...")
-            result = agent.chat(user_input)
-
-            # Display the response
-            print(f"\n🤖 Agent: {result['response']}")
+            print("\n🤖 Agent: ", end="", flush=True)
+            sources = []
+            for event in agent.chat_stream_sync(user_input):
+                if "sources" in event:
+                    sources = event["sources"]
+                elif "delta" in event:
+                    print(event["delta"], end="", flush=True)
+                elif "error" in event:
+                    print(f"I encountered an error while processing your request: {event['error']}", end="")
+            print()
 
             # Show sources
-            if result.get('sources'):
+            if sources:
                 print("\n📚 Sources:")
-                for i, source in enumerate(result['sources'][:3], 1):
+                for i, source in enumerate(sources[:3], 1):
                     print(f"   {i}. {source['title']} (relevance: {source['score']:.4f})")
 
         except KeyboardInterrupt:
@@ -264,17 +999,27 @@ def run_interactive_cli():
 def create_fastapi_app():
     """Create a FastAPI app for serving the agent as an HTTP endpoint."""
     try:
-        from fastapi import FastAPI, HTTPException
+        from contextlib import asynccontextmanager
+        from fastapi import Depends, FastAPI, HTTPException, Request
         from fastapi.middleware.cors import CORSMiddleware
+        from fastapi.responses import StreamingResponse
         from pydantic import BaseModel
     except ImportError:
         print("❌ FastAPI not installed. Run: pip install fastapi uvicorn")
         return None
 
+    @asynccontextmanager
+    async def lifespan(app):
+        # One agent per worker process, created at startup and shared by all requests
+        app.state.agent = create_agent()
+        yield
+        await app.state.agent.aclose()
+
     app = FastAPI(
         title="Multi-Modal RAG Agent",
         description="A RAG agent for querying multi-modal content (video, audio, images, PDFs)",
-        version="1.0.0"
+        version="1.0.0",
+        lifespan=lifespan
     )
 
     # Add CORS middleware
@@ -286,8 +1031,8 @@ def create_fastapi_app():
         allow_headers=["*"],
     )
 
-    # Initialize the agent
-    agent = create_agent()
+    def get_agent(http_request: Request) -> MultiModalRAGAgent:
+        return http_request.app.state.agent
 
     class ChatRequest(BaseModel):
         message: str
@@ -297,30 +1042,54 @@ def create_fastapi_app():
         response: str
         sources: list
         query: str
+        cache_hit: bool = False
+
+    class BatchChatRequest(BaseModel):
+        messages: list[str]
+        top_k: int = 5
 
     @app.get("/")
     async def root():
         return {"status": "healthy", "agent": "Multi-Modal RAG Agent"}
 
     @app.get("/health")
-    async def health():
-        return {"status": "healthy"}
+    async def health(agent: MultiModalRAGAgent = Depends(get_agent)):
+        return {"status": "healthy", "stats": agent.stats()}
 
     @app.post("/chat", response_model=ChatResponse)
-    async def chat(request: ChatRequest):
+    async def chat(request: ChatRequest, agent: MultiModalRAGAgent = Depends(get_agent)):
         """Send a message to the RAG agent and get a response."""
         try:
-            result = agent.chat(request.message, request.top_k)
+            result = await agent.chat(request.message, request.top_k)
             if "error" in result:
                 raise HTTPException(status_code=500, detail=result["error"])
             return result
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.post("/chat/stream")
+    async def chat_stream(request: ChatRequest, agent: MultiModalRAGAgent = Depends(get_agent)):
+        """Send a message to the RAG agent and stream the response as server-sent events."""
+        async def events():
+            async for event in agent.chat_stream(request.message, request.top_k):
+                yield f"data: {_DUMP(event)}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/chat/batch")
+    async def chat_batch(request: BatchChatRequest, agent: MultiModalRAGAgent = Depends(get_agent)):
+        """Send several messages at once; their embeddings are computed in batched requests."""
+        if len(request.messages) > agent.max_batch_messages:
+            raise HTTPException(
+                status_code=422,
+                detail=f"At most {agent.max_batch_messages} messages are accepted per batch"
+            )
+        return {"results": await agent.chat_many(request.messages, request.top_k)}
+
     @app.post("/api/chat")
-    async def api_chat(request: ChatRequest):
+    async def api_chat(request: ChatRequest, agent: MultiModalRAGAgent = Depends(get_agent)):
         """Alternative endpoint for chat (compatible with various frontends)."""
-        return await chat(request)
+        return await chat(request, agent)
 
     return app
 
@@ -336,16 +1105,27 @@ if __name__ == "__main__":
         # Run as HTTP server
         try:
             import uvicorn
-            app = create_fastapi_app()
-            if app:
-                print("\n🚀 Starting Multi-Modal RAG Agent Server...")
-                print("   Endpoints:")
-                print("   - POST /chat - Send chat messages")
-                print("   - GET /health - Health check")
-                print("\n")
-                uvicorn.run(app, host="0.0.0.0", port=8000)
+            import fastapi  # noqa: F401 - fail early rather than in every worker
         except ImportError:
-            print("❌ uvicorn not installed. Run: pip install uvicorn")
+            print("❌ FastAPI/uvicorn not installed. Run: pip install fastapi uvicorn")
+        else:
+            workers = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+            print("\n🚀 Starting Multi-Modal RAG Agent Server...")
+            print(f"   Workers: {workers}")
+            print("   Endpoints:")
+            print("   - POST /chat - Send chat messages")
+            print("   - POST /chat/stream - Stream chat responses (SSE)")
+            print("   - POST /chat/batch - Send several chat messages at once")
+            print("   - GET /health - Health check")
+            print("\n")
+            # Each worker process builds its own app (and agent) through the factory
+            uvicorn.run(
+                "multimodal_rag_agent:create_fastapi_app",
+                factory=True,
+                host="0.0.0.0",
+                port=8000,
+                workers=workers
+            )
     else:
         # Run interactive CLI
         run_interactive_cli()
\ No newline at end of file
@@ -0,0 +1,56 @@
+import asyncio
+
+from multimodal_rag_agent import MultiModalRAGAgent
+
+
+def make_agent():
+    # _coalesce only needs the in-flight map, so skip client initialization
+    agent = MultiModalRAGAgent.__new__(MultiModalRAGAgent)
+    agent._inflight = {}
+    return agent
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    agent = make_agent()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def scenario():
+        leader = asyncio.ensure_future(agent._coalesce("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(agent._coalesce("key", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await follower
+        return leader, result
+
+    leader, result = asyncio.run(scenario())
+
+    assert leader.cancelled()
+    assert result == "answer"
+    assert calls == [1]
+    assert agent._inflight == {}
+
+
+def test_exception_is_shared_and_key_released():
+    agent = make_agent()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def scenario():
+        return await asyncio.gather(
+            agent._coalesce("key", work),
+            agent._coalesce("key", work),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+
+    assert all(isinstance(r, ValueError) for r in results)
+    assert agent._inflight == {}